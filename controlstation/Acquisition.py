@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive acquisition for the ATR camera.
+
+While searching, the camera runs binned over the full field of view. Once
+the ATR has locked onto a marker, the camera switches to a full resolution
+sensor ROI around the crosshair window at a higher frame rate. On loss it
+switches back. Both directions use hysteresis so a single missed frame does
+not toggle the mode.
+"""
+
+import time
+
+SEARCH = "SEARCH"
+ROI = "ROI"
+
+
+class AdaptiveAcquisition:
+    def __init__(self, device, binning=2, decimation=2, search_frame_rate=20.0, roi_frame_rate=60.0,
+                 roi_margin=40, lock_frames=5, loss_frames=10):
+        self.device = device
+        self.binning = binning
+        self.decimation = decimation
+        self.search_frame_rate = search_frame_rate
+        self.roi_frame_rate = roi_frame_rate
+        self.roi_margin = roi_margin        # search pixels added around the crosshair window
+        self.lock_frames = lock_frames      # consecutive locked frames before switching to ROI
+        self.loss_frames = loss_frames      # consecutive lost frames before switching back
+
+        self.mode = SEARCH
+        self.offset_x, self.offset_y = 0, 0
+        self.roi_width, self.roi_height = None, None
+        self.search_width, self.search_height = None, None
+        self.locked_count = 0
+        self.lost_count = 0
+        self.switch_log = []                # (mode, seconds) for every switch
+
+    @property
+    def scale(self):
+        # Sensor pixels per search pixel
+        return self.binning * self.decimation
+
+    def configure_search(self):
+        """
+        Binned, decimated acquisition over the full sensor. Does not touch the stream.
+        """
+        nodemap = self.device.nodemap
+        nodemap.get_node('OffsetX').value = 0
+        nodemap.get_node('OffsetY').value = 0
+        nodemap.get_node('DecimationHorizontal').value = self.decimation
+        nodemap.get_node('DecimationVertical').value = self.decimation
+        nodemap.get_node('BinningHorizontal').value = self.binning
+        nodemap.get_node('BinningVertical').value = self.binning
+        width, height = nodemap.get_node('Width'), nodemap.get_node('Height')
+        width.value = width.max
+        height.value = height.max
+        self.search_width, self.search_height = width.value, height.value
+        self.offset_x, self.offset_y = 0, 0
+        self._set_frame_rate(self.search_frame_rate)
+        self.mode = SEARCH
+
+    def configure_roi(self, window):
+        """
+        Full resolution sensor ROI around a window. Does not touch the stream.
+
+        Parameters:
+        window (tuple): (x1, y1, x2, y2) in search frame pixels
+        """
+        nodemap = self.device.nodemap
+        x1, y1, x2, y2 = window
+        f = self.scale
+        sensor_w = nodemap.get_node('SensorWidth').value
+        sensor_h = nodemap.get_node('SensorHeight').value
+
+        nodemap.get_node('DecimationHorizontal').value = 1
+        nodemap.get_node('DecimationVertical').value = 1
+        nodemap.get_node('BinningHorizontal').value = 1
+        nodemap.get_node('BinningVertical').value = 1
+
+        # Offsets first to zero so that any width/height is allowed
+        offset_x, offset_y = nodemap.get_node('OffsetX'), nodemap.get_node('OffsetY')
+        width, height = nodemap.get_node('Width'), nodemap.get_node('Height')
+        offset_x.value = 0
+        offset_y.value = 0
+
+        ox, w = self._align((x1 - self.roi_margin) * f, (x2 + self.roi_margin) * f, sensor_w, offset_x, width)
+        oy, h = self._align((y1 - self.roi_margin) * f, (y2 + self.roi_margin) * f, sensor_h, offset_y, height)
+        width.value = w
+        height.value = h
+        offset_x.value = ox
+        offset_y.value = oy
+        self.offset_x, self.offset_y = ox, oy
+        self.roi_width, self.roi_height = w, h
+        self._set_frame_rate(self.roi_frame_rate)
+        self.mode = ROI
+
+    def switch(self, mode, window=None):
+        """
+        Stop the stream, reconfigure for the given mode and restart it.
+
+        Returns:
+        elapsed (float): Time taken by the switch in seconds
+        """
+        start_time = time.perf_counter()
+        self.device.stop_stream()
+        if mode == ROI:
+            self.configure_roi(window)
+        else:
+            self.configure_search()
+        self.device.start_stream()
+        elapsed = time.perf_counter() - start_time
+        self.switch_log.append((mode, elapsed))
+        self.locked_count, self.lost_count = 0, 0
+        print(f"Acquisition switched to {mode} in {elapsed * 1000:.1f} ms.\n")
+        return elapsed
+
+    def update(self, locked, window):
+        """
+        Feed the lock state of the current frame and switch mode if the hysteresis is exceeded.
+
+        Parameters:
+        locked (bool): Marker is inside the crosshair window
+        window (tuple): (x1, y1, x2, y2) crosshair window in search frame pixels
+
+        Returns:
+        switched (bool): True if the mode was changed
+        """
+        if locked:
+            self.locked_count += 1
+            self.lost_count = 0
+        else:
+            self.lost_count += 1
+            self.locked_count = 0
+
+        if self.mode == SEARCH and self.locked_count >= self.lock_frames:
+            self.switch(ROI, window)
+            return True
+        if self.mode == ROI and self.lost_count >= self.loss_frames:
+            self.switch(SEARCH)
+            return True
+        return False
+
+    def to_search(self, points):
+        """
+        Map frame pixel coordinates to search frame pixel coordinates.
+
+        Parameters:
+        points (np.array): Array of shape (..., 2) in pixels of the current frame
+
+        Returns:
+        points (np.array): Array of the same shape in search frame pixels
+        """
+        if self.mode == SEARCH:
+            return points
+        mapped = points.copy()
+        mapped[..., 0] = (points[..., 0] + self.offset_x) / self.scale
+        mapped[..., 1] = (points[..., 1] + self.offset_y) / self.scale
+        return mapped
+
+    def roi_in_search(self):
+        """
+        Place of the ROI in the search frame, for displaying ROI frames at search frame scale.
+
+        Returns:
+        placement (tuple): (x, y, width, height) in search frame pixels
+        """
+        x, y = self.offset_x // self.scale, self.offset_y // self.scale
+        width = min(self.roi_width // self.scale, self.search_width - x)
+        height = min(self.roi_height // self.scale, self.search_height - y)
+        return x, y, width, height
+
+    def report(self):
+        for mode in (ROI, SEARCH):
+            times = [t for m, t in self.switch_log if m == mode]
+            if times:
+                print(f"{mode}: {len(times)} switches, mean {sum(times) / len(times) * 1000:.1f} ms, "
+                      f"max {max(times) * 1000:.1f} ms")
+
+    def _set_frame_rate(self, rate):
+        nodemap = self.device.nodemap
+        nodemap.get_node('AcquisitionFrameRateEnable').value = True
+        frame_rate = nodemap.get_node('AcquisitionFrameRate')
+        frame_rate.value = min(float(rate), frame_rate.max)
+
+    def _align(self, start, stop, sensor_size, offset_node, size_node):
+        # Clamp to the sensor and snap to the increments of the nodes
+        start, stop = max(int(start), 0), min(int(stop), sensor_size)
+        size = max(stop - start, size_node.min)
+        size -= size % size_node.inc
+        start = min(start, sensor_size - size)
+        start -= start % offset_node.inc
+        return start, size
+
+
+class _Node:
+    def __init__(self, value, min=0, max=None, inc=1):
+        self.value = value
+        self.min = min
+        self.max = max
+        self.inc = inc
+
+
+class _NodeMap:
+    def __init__(self, nodes, update_limits):
+        self.nodes = nodes
+        self.update_limits = update_limits
+
+    def get_node(self, name):
+        self.update_limits()
+        if isinstance(name, list):
+            return {n: self.nodes[n] for n in name}
+        return self.nodes[name]
+
+
+class CameraStandIn:
+    """
+    Camera stand-in with the nodes used by AdaptiveAcquisition, for testing without hardware.
+    Width and Height maxima follow binning, decimation and offsets like on the real camera,
+    and the frame rate maximum follows the image height.
+    """
+
+    def __init__(self, sensor_width=2048, sensor_height=1536, switch_delay=0.05):
+        self.sensor_width = sensor_width
+        self.sensor_height = sensor_height
+        self.switch_delay = switch_delay
+        self.streaming = False
+        self.nodemap = _NodeMap({
+            'SensorWidth': _Node(sensor_width),
+            'SensorHeight': _Node(sensor_height),
+            'Width': _Node(sensor_width, min=64, max=sensor_width, inc=8),
+            'Height': _Node(sensor_height, min=64, max=sensor_height, inc=2),
+            'OffsetX': _Node(0, inc=4),
+            'OffsetY': _Node(0, inc=2),
+            'DecimationHorizontal': _Node(1, min=1, max=2),
+            'DecimationVertical': _Node(1, min=1, max=2),
+            'BinningHorizontal': _Node(1, min=1, max=4),
+            'BinningVertical': _Node(1, min=1, max=4),
+            'AcquisitionFrameRateEnable': _Node(False),
+            'AcquisitionFrameRate': _Node(20.0, min=1.0, max=200.0),
+        }, self._update_limits)
+        self.tl_stream_nodemap = {}
+
+    def start_stream(self):
+        self.streaming = True
+
+    def stop_stream(self):
+        time.sleep(self.switch_delay)
+        self.streaming = False
+
+    def _update_limits(self):
+        n = self.nodemap.nodes
+        fx = n['BinningHorizontal'].value * n['DecimationHorizontal'].value
+        fy = n['BinningVertical'].value * n['DecimationVertical'].value
+        n['Width'].max = (self.sensor_width - n['OffsetX'].value) // fx
+        n['Height'].max = (self.sensor_height - n['OffsetY'].value) // fy
+        n['AcquisitionFrameRate'].max = 200.0 * 256 / max(n['Height'].value, 256)
+
+
+if __name__ == "__main__":
+    camera = CameraStandIn()
+    acquisition = AdaptiveAcquisition(camera)
+    acquisition.configure_search()
+    camera.start_stream()
+    window = (acquisition.search_width // 2 - 118, acquisition.search_height // 2 - 80,
+              acquisition.search_width // 2 + 82, acquisition.search_height // 2 + 200)
+
+    # Searching, locked, short dropout, locked, lost
+    for locked in [False] * 3 + [True] * 6 + [False] * 3 + [True] * 3 + [False] * 12:
+        acquisition.update(locked, window)
+        nodes = camera.nodemap.nodes
+        print(f"{acquisition.mode}: {nodes['Width'].value}x{nodes['Height'].value} "
+              f"+{nodes['OffsetX'].value}+{nodes['OffsetY'].value} @ {nodes['AcquisitionFrameRate'].value:.1f} fps")
+    acquisition.report()
@@ -86,6 +86,29 @@ class Printer:
         print("Failed to send command after multiple retries.")
         return None
 
+    def wait_for_moves(self, timeout=10):
+        """
+        Send M400 and read until the printer acknowledges that all moves are finished.
+        A single readline is not enough, the ok only arrives once the axes have stopped.
+        """
+        if not self.serial_connection or not self.serial_connection.is_open:
+            print("Serial connection is not open.")
+            return False
+        try:
+            self.serial_connection.write("M400\n".encode('utf-8'))
+            start_time = time.time()
+            while (time.time() - start_time) < timeout:
+                response = self.serial_connection.readline().decode('utf-8').strip()
+                if response.startswith('ok'):
+                    return True
+                if response:
+                    print(f"Response: {response}")
+        except serial.SerialException as e:
+            print(f"Serial communication error: {e}")
+            return False
+        print(f"Moves not finished after {timeout} s.")
+        return False
+
     def capture_position(self):
         self.flush_initial_data()
         print("Current Position:")
@@ -17,6 +17,7 @@ import time
 import ctypes
 import serial
 from Devices import Printer, EDM
+from Acquisition import AdaptiveAcquisition, SEARCH, ROI
 
 class MouseControlApp:
     def __init__(self, root):
@@ -85,10 +86,14 @@ class MouseControlApp:
         self.change_atr = tk.Button(self.sidebar, text="ATR: OFF", command=self.switch_atr)
         self.change_atr.pack(pady=5)
 
+        self.change_adaptive = tk.Button(self.sidebar, text="Adaptive: OFF", command=self.switch_adaptive)
+        self.change_adaptive.pack(pady=5)
+
         # Device states
         self.position = True
         self.laser_state = False
         self.atr_state = False 
+        self.adaptive_state = False
     
         # Initial values of x and y
         self.x, self.y = 0, 0
@@ -109,6 +114,7 @@ class MouseControlApp:
         self.canvas.bind("<Motion>", self.on_mouse_move)
 
         self.device = None
+        self.acquisition = None
 
         # Start the drawing loop
         self.draw()
@@ -160,12 +166,8 @@ class MouseControlApp:
         nodes['PixelFormat'].value = 'Mono8'
 
         tl_stream_nodemap = device.tl_stream_nodemap
-        nodemap.get_node('DecimationHorizontal').value = 2
-        nodemap.get_node('DecimationVertical').value = 2
-        nodemap.get_node('BinningHorizontal').value = 2
-        nodemap.get_node('BinningVertical').value = 2
-        nodemap.get_node('AcquisitionFrameRateEnable').value = True
-        nodemap.get_node('AcquisitionFrameRate').value = 20.0
+        self.acquisition = AdaptiveAcquisition(device)
+        self.acquisition.configure_search()
         nodemap.get_node("AcquisitionMode").value = "Continuous"
         nodemap.get_node('ExposureAuto').value = "Once"
         nodemap.get_node('Gain').value = 10.0
@@ -249,6 +251,14 @@ class MouseControlApp:
         self.change_atr.config(text=f"ATR: {state}")
         print(f"ATR turned {state}.\n")
 
+    def switch_adaptive(self):
+        self.adaptive_state = not self.adaptive_state
+        state = "ON" if self.adaptive_state else "OFF"
+        self.change_adaptive.config(text=f"Adaptive: {state}")
+        print(f"Adaptive acquisition turned {state}.\n")
+        if not self.adaptive_state and self.acquisition is not None and self.acquisition.mode == ROI:
+            self.acquisition.switch(SEARCH)
+
     def calc_offset(self, distance):
         if distance is not None:
             offset_y = (np.interp(distance, self.data_dist, self.data_y))/2
@@ -256,6 +266,15 @@ class MouseControlApp:
             return offset_x, offset_y
         return None
 
+    def crosshair_window(self, width, height):
+        offset_x, offset_y = -18, 60
+        center_x, center_y = width // 2 + offset_x, height // 2 + offset_y
+
+        roi_x, roi_y = 100, 140
+        x1, y1 = max(center_x - roi_x, 0), max(center_y - roi_y, 0)
+        x2, y2 = min(center_x + roi_x, width), min(center_y + roi_y, height)
+        return center_x, center_y, (x1, y1, x2, y2)
+
     def draw(self):
         self.canvas.delete("all")
         if self.device is not None:
@@ -267,7 +286,12 @@ class MouseControlApp:
             frame = np.ndarray(buffer=array, dtype=np.uint8, shape=(item.height, item.width))
             self.corners, ids, _ = self.detector.detectMarkers(frame)
             frame_markers = aruco.drawDetectedMarkers(frame.copy(), self.corners, ids)
-            height, width = frame.shape
+            # Control always works in search frame pixels, also while the ROI is active
+            self.corners = tuple(self.acquisition.to_search(corner) for corner in self.corners)
+            height, width = self.acquisition.search_height, self.acquisition.search_width
+            center_x, center_y, window = self.crosshair_window(width, height)
+            x1, y1, x2, y2 = window
+            locked = False
 
             if self.atr_state and ids is not None:
                 for i, corner in enumerate(self.corners):
@@ -277,14 +301,8 @@ class MouseControlApp:
                     y_sum = self.corners[0][0][0][1] + self.corners[0][0][1][1] + self.corners[0][0][2][1] + self.corners[0][0][3][1]
                     self.marker_coords = (x_sum * 0.25, y_sum * 0.25)
 
-                    offset_x, offset_y = -18, 60
-                    center_x, center_y = width // 2 + offset_x, height // 2 + offset_y
-                    
-                    roi_x, roi_y = 100, 140
-                    x1, y1 = max(center_x - roi_x, 0), max(center_y - roi_y, 0)
-                    x2, y2 = min(center_x + roi_x, width), min(center_y + roi_y, height)
-                    
                     if x1 <= self.marker_coords[0] <= x2 and y1 <= self.marker_coords[1] <= y2:
+                        locked = True
                         distance = self.edm.capture_distance()
                         center_x_fine, center_y_fine = self.calc_offset(distance)
                         print(f"Center_y: {center_y_fine}")
@@ -313,6 +331,13 @@ class MouseControlApp:
                 
             # Capture frame-by-frame
             
+            if self.acquisition.mode == ROI:
+                # Show the ROI at search frame scale and position so the crosshair keeps its meaning
+                x0, y0, w, h = self.acquisition.roi_in_search()
+                display = np.zeros((height, width), dtype=np.uint8)
+                display[y0:y0 + h, x0:x0 + w] = cv2.resize(frame_markers, (w, h), interpolation=cv2.INTER_AREA)
+                frame_markers = display
+
             img = Image.fromarray(frame_markers)
             imgtk = ImageTk.PhotoImage(image=img)
 
@@ -331,6 +356,8 @@ class MouseControlApp:
         self.update_position()
         if self.device is not None:
             BufferFactory.destroy(item)
+            if self.adaptive_state:
+                self.acquisition.update(locked, window)
         self.root.after(20, self.draw)
 
     def on_closing(self):
@@ -339,6 +366,7 @@ class MouseControlApp:
             orden = f"G1 X0 Y0 F3600\r\n"
             print(orden)
             self.printer.send_command(orden)
+            self.acquisition.report()
             self.device.stop_stream()
             system.destroy_device()
         except:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Grid scanning with the printer axes and the EDM.
+
+The instrument sweeps a Hz/V window on a grid, measures a distance at every
+node and streams the georeferenced points to a binary PLY file. Points are
+collected in a fixed size buffer that is transformed and written once it is
+full, so memory use does not grow with the size of the scan.
+"""
+
+import math
+import os
+import sys
+import time
+import numpy as np
+
+# Launchpad style runs from controlstation/, make the transform package importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transform.Helmert import transform_measurement, load_params
+
+class PLYWriter:
+    """
+    Binary little endian PLY writer for x, y, z points of unknown final count.
+    The vertex count in the header is a fixed width field that is patched on close.
+    """
+    COUNT_WIDTH = 12
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.file = open(path, 'wb')
+        header = ("ply\n"
+                  "format binary_little_endian 1.0\n"
+                  "comment OpenTachy grid scan\n")
+        self.file.write(header.encode('ascii'))
+        self.count_position = self.file.tell()
+        self.file.write(self._vertex_line(0))
+        self.file.write(("property double x\n"
+                         "property double y\n"
+                         "property double z\n"
+                         "end_header\n").encode('ascii'))
+
+    def _vertex_line(self, count):
+        return f"element vertex {count:0{self.COUNT_WIDTH}d}\n".encode('ascii')
+
+    def write(self, points):
+        self.file.write(np.ascontiguousarray(points, dtype='<f8').tobytes())
+        self.count += len(points)
+
+    def close(self):
+        self.file.seek(self.count_position)
+        self.file.write(self._vertex_line(self.count))
+        self.file.close()
+
+
+class GridScanner:
+    FEED_RATE = 3600        # printer units per minute, as in Launchpad
+    MOVE_MARGIN = 2.0       # seconds added to the expected move time
+
+    def __init__(self, printer, edm, params, chunk_size=1024):
+        self.printer = printer
+        self.edm = edm
+        self.params = params
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros((chunk_size, 3))   # [Hz, V, r] of the current chunk
+        self.position = None                      # last commanded (Hz, V)
+
+    def grid(self, hz_min, hz_max, v_min, v_max, step_hz, step_v):
+        """
+        Grid nodes as (Hz, V) in gon, row by row in serpentine order to keep the moves short.
+        """
+        if step_hz <= 0 or step_v <= 0:
+            raise ValueError(f"Grid steps must be positive, got {step_hz} and {step_v}.")
+        if hz_min > hz_max or v_min > v_max:
+            raise ValueError(f"Empty scan window Hz {hz_min}..{hz_max}, V {v_min}..{v_max}.")
+        # Small epsilon so that a window of whole steps keeps its last node despite rounding
+        n_hz = math.floor((hz_max - hz_min) / step_hz + 1e-9) + 1
+        n_v = math.floor((v_max - v_min) / step_v + 1e-9) + 1
+        for row in range(n_v):
+            v = v_min + row * step_v
+            columns = range(n_hz) if row % 2 == 0 else range(n_hz - 1, -1, -1)
+            for column in columns:
+                yield hz_min + column * step_hz, v
+
+    def move(self, hz, v):
+        """
+        Move to (Hz, V) and wait until the axes have stopped.
+
+        Returns:
+        arrived (bool): False if the printer did not confirm the move in time
+        """
+        if self.position is None:
+            timeout = 60.0
+        else:
+            distance = max(abs(hz - self.position[0]), abs(v - self.position[1]))
+            timeout = distance / (self.FEED_RATE / 60) + self.MOVE_MARGIN
+        # Printer X is Hz, printer Y is V - 100 (see Printer.capture_position)
+        self.printer.send_command(f"G1 X{hz:.3f} Y{v - 100:.3f} F{self.FEED_RATE}")
+        self.position = hz, v
+        return self.printer.wait_for_moves(timeout)
+
+    def scan(self, path, hz_min, hz_max, v_min, v_max, step_hz, step_v):
+        """
+        Scan a Hz/V window and stream the georeferenced points to a binary PLY file.
+
+        Parameters:
+        path (str): Output PLY file
+        hz_min, hz_max (float): Horizontal window in gon
+        v_min, v_max (float): Vertical window in gon
+        step_hz, step_v (float): Grid spacing in gon
+
+        Returns:
+        report (dict): Number of grid nodes, written points, missed distances, elapsed time and points/second
+        """
+        writer = PLYWriter(path)
+        n_nodes, n_missed, n_buffered = 0, 0, 0
+        start_time = time.perf_counter()
+        try:
+            for hz, v in self.grid(hz_min, hz_max, v_min, v_max, step_hz, step_v):
+                n_nodes += 1
+                if not self.move(hz, v):
+                    n_missed += 1
+                    continue
+                distance = self.edm.capture_distance()
+                if distance is None:
+                    n_missed += 1
+                    continue
+                self.buffer[n_buffered] = hz, v, distance
+                n_buffered += 1
+                if n_buffered == self.chunk_size:
+                    self.flush(writer, n_buffered)
+                    n_buffered = 0
+            self.flush(writer, n_buffered)
+        finally:
+            writer.close()
+        elapsed = time.perf_counter() - start_time
+
+        report = {
+            'nodes': n_nodes,
+            'points': writer.count,
+            'missed': n_missed,
+            'elapsed': elapsed,
+            'points_per_second': writer.count / elapsed if elapsed > 0 else 0.0
+        }
+        print(f"Scan finished: {writer.count} points of {n_nodes} nodes ({n_missed} missed) "
+              f"in {elapsed:.1f} s, {report['points_per_second']:.2f} points/s.\n")
+        return report
+
+    def flush(self, writer, n):
+        if n == 0:
+            return
+        writer.write(transform_measurement(self.buffer[:n], self.params))
+        print(f"Written {writer.count} points to {writer.path}")
+
+
+if __name__ == "__main__":
+    # python Scanner.py helmert.json scan.ply hz_min hz_max v_min v_max step_hz step_v
+    from Devices import Printer, EDM
+
+    if len(sys.argv) != 9:
+        print("Usage: python Scanner.py helmert.json scan.ply hz_min hz_max v_min v_max step_hz step_v")
+        sys.exit(1)
+    params_path, ply_path = sys.argv[1], sys.argv[2]
+    hz_min, hz_max, v_min, v_max, step_hz, step_v = (float(a) for a in sys.argv[3:])
+
+    printer = Printer("/dev/usbPRI", 250000)
+    edm = EDM("/dev/usbEDM", 19200)
+    if not printer.connect() or not edm.connect():
+        print("No connection to Printer or EDM\n")
+        sys.exit(1)
+    try:
+        scanner = GridScanner(printer, edm, load_params(params_path))
+        scanner.scan(ply_path, hz_min, hz_max, v_min, v_max, step_hz, step_v)
+    finally:
+        printer.send_command("G1 X0 Y0 F3600")
+        printer.disconnect()
+        edm.disconnect()
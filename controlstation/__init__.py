@@ -1,2 +1,3 @@
 from .Devices import Printer, EDM
-from .Launchpad import MouseControlApp
\ No newline at end of file
+from .Launchpad import MouseControlApp
+from .Scanner import GridScanner
\ No newline at end of file
@@ -5,6 +5,7 @@ Created on Tue Jun 18 09:16:18 2024
 @author: Paul
 """
 
+import json
 import numpy as np
 
 def helmert_transformation_3d(source_points_polar, target_points):
@@ -34,6 +35,11 @@ def helmert_transformation_3d(source_points_polar, target_points):
     # Singular Value Decomposition (SVD)
     U, S, Vt = np.linalg.svd(np.dot(centered_source.T, centered_target))
     
+    # Kabsch correction, flip the last singular vector if U*Vt would be a reflection
+    if np.linalg.det(np.dot(U, Vt)) < 0:
+        U[:, -1] *= -1
+        S[-1] *= -1
+
     # Compute rotation matrix
     R = np.dot(U, Vt)
 
@@ -102,6 +108,40 @@ def transform_measurement(measurements_polar, params):
     transformed_measurements = scale * np.dot(measurements, R) + translation
     return transformed_measurements
 
+def save_params(params, path):
+    """
+    Store Helmert transformation parameters as JSON.
+    
+    Parameters:
+    params (dict): Dictionary containing scale, rotation matrix, and translation vector
+    path (str): Path of the JSON file
+    """
+    data = {
+        'scale': float(params['scale']),
+        'rotation_matrix': np.asarray(params['rotation_matrix']).tolist(),
+        'translation_vector': np.asarray(params['translation_vector']).tolist()
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+def load_params(path):
+    """
+    Load Helmert transformation parameters stored with save_params.
+    
+    Parameters:
+    path (str): Path of the JSON file
+    
+    Returns:
+    params (dict): Dictionary containing scale, rotation matrix, and translation vector
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return {
+        'scale': data['scale'],
+        'rotation_matrix': np.array(data['rotation_matrix']),
+        'translation_vector': np.array(data['translation_vector'])
+    }
+
 # # Beispiel: Bekannte Referenzpunkte (Zielpunkte) in globalen Koordinaten (X,Y,Z)
 # target_points = np.array([
 #     [2.2446,2.7253,0.1361],  
@@ -132,3 +172,17 @@ def transform_measurement(measurements_polar, params):
 # transformed_measurements = transform_measurement(measurements_polar, params)
 
 # #print("Transformierte Messwerte:\n", transformed_measurements)
+
+if __name__ == "__main__":
+    # python Helmert.py control.csv helmert.json
+    # control.csv: one control point per line, Hz, V, r measured and X, Y, Z known
+    import sys
+
+    if len(sys.argv) != 3:
+        print("Usage: python Helmert.py control.csv helmert.json")
+        sys.exit(1)
+    control = np.loadtxt(sys.argv[1], delimiter=',', ndmin=2)
+    transformed_points, params, residuals = helmert_transformation_3d(control[:, :3], control[:, 3:6])
+    print("Residuen:\n", residuals)
+    save_params(params, sys.argv[2])
+    print(f"Saved transformation parameters to {sys.argv[2]}")
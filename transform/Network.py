@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Least squares adjustment of a multi station network.
+
+Every station measures polar coordinates to a set of points. The points
+shared between stations tie the stations together, the control points fix
+the datum. All station parameters and new point coordinates are solved in
+one Gauss-Markov model with sparse normal equations.
+"""
+
+import time
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from transform.Helmert import helmert_transformation_3d, polar_to_cartesian, transform_measurement
+
+STATION_UNKNOWNS = 7    # translation (3), rotation (3), inverse scale (1)
+
+def network_adjustment(observations, control_points, max_iterations=10,
+                       tolerance_position=1e-6, tolerance_rotation=1e-9, tolerance_scale=1e-9):
+    """
+    Adjust all stations and new points of a network at once.
+
+    Parameters:
+    observations (dict): {station_id: (point_ids, polar_points)} with polar_points of shape (n_points, 3) [phi, theta, r]
+    control_points (dict): {point_id: np.array of shape (3,)} fixed coordinates defining the datum
+    max_iterations (int): Maximum number of Gauss-Newton iterations
+    tolerance_position (float): Convergence limit for translations and point coordinates in m
+    tolerance_rotation (float): Convergence limit for rotations in rad
+    tolerance_scale (float): Convergence limit for the inverse scale
+
+    Returns:
+    stations (dict): {station_id: transformation_params} usable with transform_measurement
+    points (dict): {point_id: np.array of shape (3,)} adjusted coordinates of the new points
+    residuals (dict): {station_id: residuals array of shape (n_points,)} in the station frame
+    report (dict): Iterations, converged flag, sigma0, number of unknowns and observations, run time
+    """
+    start_time = time.perf_counter()
+
+    # Work in coordinates reduced to the control centroid, large (e.g. UTM) values lose precision
+    if not control_points:
+        raise ValueError("At least three control points are needed to define the datum.")
+    origin = np.mean([np.asarray(c, dtype=float) for c in control_points.values()], axis=0)
+    control_points = {p: np.asarray(c, dtype=float) - origin for p, c in control_points.items()}
+    stations, points = initial_values(observations, control_points)
+
+    station_ids = list(observations)
+    point_ids = list(points)
+    station_index = {s: i for i, s in enumerate(station_ids)}
+    point_index = {p: i for i, p in enumerate(point_ids)}
+    n_stations, n_points = len(station_ids), len(point_ids)
+    n_unknowns = STATION_UNKNOWNS * n_stations + 3 * n_points
+
+    # Flatten the observations, fixed points get point index -1
+    obs_station, obs_point, obs_fixed, obs_local = [], [], [], []
+    for s, (ids, polar) in observations.items():
+        obs_station.extend([station_index[s]] * len(ids))
+        obs_point.extend(point_index.get(p, -1) for p in ids)
+        obs_fixed.extend(control_points[p] if p in control_points else np.zeros(3) for p in ids)
+        obs_local.append(polar_to_cartesian(np.asarray(polar, dtype=float)))
+    obs_station = np.array(obs_station)
+    obs_point = np.array(obs_point)
+    obs_fixed = np.array(obs_fixed, dtype=float)
+    obs_local = np.vstack(obs_local)
+    n_obs = len(obs_station)
+    free = obs_point >= 0
+    redundancy = 3 * n_obs - n_unknowns
+    if redundancy < 0:
+        raise ValueError(f"Network has {n_unknowns} unknowns but only {3 * n_obs} observations.")
+
+    # Station model: x = mu * R (X - t), with mu the inverse scale of the Helmert solution
+    t = np.array([stations[s]['translation_vector'] for s in station_ids], dtype=float)
+    R = np.array([stations[s]['rotation_matrix'] for s in station_ids], dtype=float)
+    mu = np.array([1 / stations[s]['scale'] for s in station_ids], dtype=float)
+    X = np.array([points[p] for p in point_ids], dtype=float).reshape(-1, 3)
+
+    # Column indices of the Jacobian blocks, rows are 3 per observation
+    rows = np.arange(3 * n_obs).reshape(n_obs, 3)
+    station_cols = STATION_UNKNOWNS * obs_station[:, None] + np.arange(STATION_UNKNOWNS)
+    point_cols = STATION_UNKNOWNS * n_stations + 3 * obs_point[free, None] + np.arange(3)
+
+    converged = False
+    for iteration in range(1, max_iterations + 1):
+        Xo = obs_fixed.copy()
+        Xo[free] = X[obs_point[free]]
+        Ro, muo = R[obs_station], mu[obs_station]
+        y = np.einsum('nij,nj->ni', Ro, Xo - t[obs_station])
+        misclosure = obs_local - muo[:, None] * y
+
+        # Partial derivatives of x with respect to t, rotation, mu and X
+        dX = muo[:, None, None] * Ro
+        station_block = np.concatenate([-dX, -muo[:, None, None] * skew(y), y[:, :, None]], axis=2)
+
+        A_rows = np.concatenate([np.repeat(rows, STATION_UNKNOWNS, axis=1).ravel(),
+                                 np.repeat(rows[free], 3, axis=1).ravel()])
+        A_cols = np.concatenate([np.tile(station_cols, (1, 3)).ravel(),
+                                 np.tile(point_cols, (1, 3)).ravel()])
+        A_vals = np.concatenate([station_block.ravel(), dX[free].ravel()])
+        A = sparse.csr_matrix((A_vals, (A_rows, A_cols)), shape=(3 * n_obs, n_unknowns))
+
+        # Normal equations and sparse factorization
+        N = (A.T @ A).tocsr()
+        n = A.T @ misclosure.ravel()
+        dx = solve_normal_equations(N, n, STATION_UNKNOWNS * n_stations)
+
+        ds = dx[:STATION_UNKNOWNS * n_stations].reshape(n_stations, STATION_UNKNOWNS)
+        t += ds[:, 0:3]
+        R = np.einsum('nij,njk->nik', rotation(ds[:, 3:6]), R)
+        mu += ds[:, 6]
+        dp = dx[STATION_UNKNOWNS * n_stations:]
+        X += dp.reshape(-1, 3)
+
+        if (np.max(np.abs(ds[:, 0:3]), initial=0) < tolerance_position
+                and np.max(np.abs(dp), initial=0) < tolerance_position
+                and np.max(np.abs(ds[:, 3:6]), initial=0) < tolerance_rotation
+                and np.max(np.abs(ds[:, 6]), initial=0) < tolerance_scale):
+            converged = True
+            break
+
+    Xo = obs_fixed.copy()
+    Xo[free] = X[obs_point[free]]
+    y = np.einsum('nij,nj->ni', R[obs_station], Xo - t[obs_station])
+    v = mu[obs_station, None] * y - obs_local
+    sigma0 = np.sqrt(np.sum(v ** 2) / redundancy) if redundancy > 0 else 0.0
+    elapsed = time.perf_counter() - start_time
+
+    stations = {s: {'scale': 1 / mu[i], 'rotation_matrix': R[i], 'translation_vector': t[i] + origin}
+                for i, s in enumerate(station_ids)}
+    points = {p: X[i] + origin for i, p in enumerate(point_ids)}
+    norms = np.linalg.norm(v, axis=1)
+    residuals = {s: norms[obs_station == i] for i, s in enumerate(station_ids)}
+    report = {
+        'iterations': iteration,
+        'converged': converged,
+        'sigma0': sigma0,
+        'unknowns': n_unknowns,
+        'observations': 3 * n_obs,
+        'elapsed': elapsed
+    }
+    print(f"Network adjusted: {n_stations} stations, {n_points} new points, {n_unknowns} unknowns, "
+          f"{iteration} iterations, sigma0 {sigma0:.5f} in {elapsed:.2f} s.")
+    if not converged:
+        print(f"Warning: network adjustment did not converge in {max_iterations} iterations, "
+              f"the solution is not reliable.")
+    return stations, points, residuals, report
+
+def solve_normal_equations(N, n, n_station_unknowns):
+    """
+    Solve the normal equations by eliminating the point unknowns first.
+
+    The point part of N is block diagonal with 3x3 blocks, so it is inverted block by block
+    and only the reduced system of the station unknowns (Schur complement) is factorized.
+
+    Parameters:
+    N (sparse matrix): Normal matrix, station unknowns first, then points
+    n (np.array): Right hand side
+    n_station_unknowns (int): Number of station unknowns
+
+    Returns:
+    dx (np.array): Corrections to all unknowns
+    """
+    k = n_station_unknowns
+    N_ss, N_sp, N_pp = N[:k, :k], N[:k, k:], N[k:, k:]
+    n_s, n_p = n[:k], n[k:]
+
+    n_points = N_pp.shape[0] // 3
+    blocks = np.zeros((n_points, 3, 3))
+    coo = N_pp.tocoo()
+    blocks[coo.row // 3, coo.row % 3, coo.col % 3] = coo.data
+    try:
+        inverse = np.linalg.inv(blocks)
+    except np.linalg.LinAlgError:
+        raise ValueError("Normal equations are singular, a new point is not determined by its observations.")
+    index = np.arange(3 * n_points).reshape(n_points, 3)
+    N_pp_inv = sparse.csr_matrix((inverse.ravel(), (np.repeat(index, 3, axis=1).ravel(), np.tile(index, (1, 3)).ravel())),
+                                 shape=N_pp.shape)
+
+    reduced = (N_ss - N_sp @ N_pp_inv @ N_sp.T).tocsc()
+    ds = spsolve(reduced, n_s - N_sp @ (N_pp_inv @ n_p))
+    if not np.all(np.isfinite(ds)):
+        raise ValueError("Normal equations are singular, check the datum and the network geometry.")
+    dp = N_pp_inv @ (n_p - N_sp.T @ ds)
+    return np.concatenate([ds, dp])
+
+def initial_values(observations, control_points):
+    """
+    Approximate station parameters and point coordinates.
+
+    Stations with at least three known, not collinear points are solved with helmert_transformation_3d,
+    their new points become known and the remaining stations are chained on.
+
+    Parameters:
+    observations (dict): {station_id: (point_ids, polar_points)}
+    control_points (dict): {point_id: np.array of shape (3,)}
+
+    Returns:
+    stations (dict): {station_id: transformation_params}
+    points (dict): {point_id: np.array of shape (3,)} approximate coordinates of the new points
+    """
+    known = {p: np.asarray(c, dtype=float) for p, c in control_points.items()}
+    points, stations = {}, {}
+    pending = list(observations)
+    while pending:
+        solved = []
+        for s in pending:
+            ids, polar = observations[s]
+            polar = np.asarray(polar, dtype=float)
+            common = [i for i, p in enumerate(ids) if p in known]
+            if len(common) < 3:
+                continue
+            target = np.array([known[ids[i]] for i in common])
+            if degenerate(target):
+                continue
+            _, params, _ = helmert_transformation_3d(polar[common], target)
+            stations[s] = params
+            new = [i for i, p in enumerate(ids) if p not in known]
+            if new:
+                for i, coordinates in zip(new, transform_measurement(polar[new], params)):
+                    known[ids[i]] = points[ids[i]] = coordinates
+            solved.append(s)
+        if not solved:
+            raise ValueError(f"Stations {pending} cannot be connected to at least three known, not collinear points.")
+        pending = [s for s in pending if s not in solved]
+    return stations, points
+
+def degenerate(points, tolerance=1e-3):
+    """
+    True if the points are (nearly) coincident or collinear and cannot define a rotation.
+
+    Parameters:
+    points (np.array): Points array of shape (n_points, 3)
+    tolerance (float): Limit for the ratio of the second to the first singular value
+    """
+    S = np.linalg.svd(points - np.mean(points, axis=0), compute_uv=False)
+    return S[0] == 0 or S[1] < tolerance * S[0]
+
+def skew(v):
+    """
+    Cross product matrices of shape (n, 3, 3) for vectors of shape (n, 3).
+    """
+    S = np.zeros(v.shape[:-1] + (3, 3))
+    S[..., 0, 1], S[..., 0, 2] = -v[..., 2], v[..., 1]
+    S[..., 1, 0], S[..., 1, 2] = v[..., 2], -v[..., 0]
+    S[..., 2, 0], S[..., 2, 1] = -v[..., 1], v[..., 0]
+    return S
+
+def rotation(v):
+    """
+    Rotation matrices of shape (n, 3, 3) for rotation vectors of shape (n, 3) (Rodrigues).
+    """
+    angle = np.linalg.norm(v, axis=1)
+    safe = np.where(angle > 0, angle, 1.0)
+    K = skew(v / safe[:, None])
+    s, c = np.sin(angle)[:, None, None], np.cos(angle)[:, None, None]
+    return np.eye(3) + s * K + (1 - c) * np.einsum('nij,njk->nik', K, K)
+
+if __name__ == "__main__":
+    # Reproducible check with a known solution: python -m transform.Network
+    rng = np.random.default_rng(28)
+    noise = 0.001
+    offset = np.array([500000.0, 5400000.0, 300.0])     # UTM sized coordinates
+
+    def to_polar(local):
+        # Inverse of polar_to_cartesian
+        r = np.linalg.norm(local, axis=1)
+        phi = np.degrees(np.arctan2(local[:, 0], local[:, 1])) / 0.9
+        theta = np.degrees(np.arccos(local[:, 2] / r)) / 0.9
+        return np.column_stack([np.mod(phi, 400), theta, r - 0.060])
+
+    # Control points, the first three near station S0, the others far from it
+    control = np.array([[-45, -30, 1.0], [-30, -45, 0.5], [-35, -35, 2.0],
+                        [45, 45, 1.0], [45, -45, 0.0], [-45, 45, 1.5], [0, 0, 0.5], [20, 40, -1.0]])
+    new = np.column_stack([rng.uniform(-50, 50, (300, 2)), rng.uniform(-2, 2, 300)])
+    truth = np.vstack([control, new])
+    control_points = {i: control[i] + offset for i in range(len(control))}
+
+    station_positions = np.vstack([[-40, -40, 1.6], np.column_stack([rng.uniform(-40, 40, (24, 2)), np.full(24, 1.6)])])
+    observations, true_stations = {}, {}
+    for k, position in enumerate(station_positions):
+        visible = np.linalg.norm(truth[:, :2] - position[:2], axis=1) < 35
+        if k == 0:
+            visible[3:len(control)] = False     # S0 sees exactly three control points
+        ids = [int(i) for i in np.flatnonzero(visible)]
+        kappa, tilt = rng.uniform(0, 2 * np.pi), rng.normal(0, 1e-3, 2)
+        R = rotation(np.array([[tilt[0], tilt[1], kappa]]))[0]
+        local = (truth[ids] - position) @ R.T + rng.normal(0, noise, (len(ids), 3))
+        observations[f"S{k}"] = (ids, to_polar(local))
+        true_stations[f"S{k}"] = R
+    assert len(set(observations["S0"][0]) & set(control_points)) == 3
+
+    stations, points, residuals, report = network_adjustment(observations, control_points)
+    errors = np.array([np.linalg.norm(points[p] - offset - truth[p]) for p in points])
+    rotation_errors = [np.abs(stations[s]['rotation_matrix'] - R).max() for s, R in true_stations.items()]
+    print(f"Max point error {errors.max() * 1000:.2f} mm, max rotation error {max(rotation_errors):.2e}, "
+          f"sigma0 / noise {report['sigma0'] / noise:.3f}")
+    assert report['converged']
+    assert errors.max() < 5 * noise
+    assert max(rotation_errors) < 1e-3
+    assert 0.8 < report['sigma0'] / noise < 1.2
+    print("Network adjustment check passed.")